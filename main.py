@@ -1,10 +1,13 @@
 import os
 import logging
-import psycopg2
-import pytz
+import asyncio
+import time
+import asyncpg
 import datetime
+from zoneinfo import ZoneInfo
 from telegram import Update
-from telegram.ext import Application, CommandHandler, ContextTypes
+from telegram.error import NetworkError, RetryAfter, TimedOut
+from telegram.ext import Application, CommandHandler, ContextTypes, Defaults
 
 # --- CONFIGURATION ---
 TOKEN = os.getenv("TELEGRAM_TOKEN")
@@ -17,68 +20,82 @@ logging.basicConfig(
 )
 
 # --- DATABASE SETUP ---
-def init_db():
-    conn = psycopg2.connect(DB_URL)
-    c = conn.cursor()
-    
-    # 1. Table for Members
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS members (
-            user_id BIGINT PRIMARY KEY,
-            chat_id BIGINT,
-            full_name TEXT,
-            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    # 2. Table for State (Remembering whose turn it is)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS bot_state (
-            id INTEGER PRIMARY KEY,
-            current_index INTEGER
-        )
-    """)
-    
-    # Initialize state if empty
-    c.execute("INSERT INTO bot_state (id, current_index) VALUES (1, -1) ON CONFLICT (id) DO NOTHING")
-    
-    conn.commit()
-    conn.close()
-
-def add_user(user_id, chat_id, full_name):
-    conn = psycopg2.connect(DB_URL)
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO members (user_id, chat_id, full_name)
-        VALUES (%s, %s, %s)
-        ON CONFLICT (user_id) DO UPDATE SET full_name = EXCLUDED.full_name, chat_id = EXCLUDED.chat_id
-    """, (user_id, chat_id, full_name))
-    conn.commit()
-    conn.close()
-
-def get_rotation_info():
-    """Fetches all members and the current index state."""
-    conn = psycopg2.connect(DB_URL)
-    c = conn.cursor()
-    
-    # Get all members sorted by join time (or user_id) so the order is stable
-    c.execute("SELECT chat_id, full_name FROM members ORDER BY joined_at ASC, user_id ASC")
-    members = c.fetchall()
-    
-    # Get last index
-    c.execute("SELECT current_index FROM bot_state WHERE id = 1")
-    current_index = c.fetchone()[0]
-    
-    conn.close()
-    return members, current_index
-
-def update_index(new_index):
-    """Saves the new index to the DB."""
-    conn = psycopg2.connect(DB_URL)
-    c = conn.cursor()
-    c.execute("UPDATE bot_state SET current_index = %s WHERE id = 1", (new_index,))
-    conn.commit()
-    conn.close()
+# Async pool so DB calls never block the event loop. Created in post_init
+# because asyncpg needs a running loop.
+pool = None
+
+async def init_db(application):
+    global pool
+    # asyncpg prepares and caches statements per connection, so repeated
+    # queries (the /join INSERT, the rotation reads) skip parse+plan.
+    pool = await asyncpg.create_pool(
+        DB_URL, min_size=1, max_size=5, statement_cache_size=100
+    )
+
+    async with pool.acquire() as c:
+        # Tables for members and state (whose turn it is), plus the state
+        # seed row. One script so the whole bootstrap is a single round-trip.
+        await c.execute("""
+            CREATE TABLE IF NOT EXISTS members (
+                user_id BIGINT PRIMARY KEY,
+                chat_id BIGINT,
+                full_name TEXT,
+                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            CREATE TABLE IF NOT EXISTS bot_state (
+                id INTEGER PRIMARY KEY,
+                current_index INTEGER
+            );
+            INSERT INTO bot_state (id, current_index) VALUES (1, -1) ON CONFLICT (id) DO NOTHING;
+            -- Matches the rotation ORDER BY; INCLUDE makes reads index-only.
+            CREATE INDEX IF NOT EXISTS members_rotation_idx
+                ON members (joined_at ASC, user_id ASC) INCLUDE (chat_id, full_name);
+        """)
+
+# Short-lived cache of the member count so the daily job and /test don't
+# re-query it on every run. /join invalidates it.
+_cache = {"count": None, "ts": 0.0}
+
+async def add_user(user_id, chat_id, full_name):
+    async with pool.acquire() as c:
+        await c.execute("""
+            INSERT INTO members (user_id, chat_id, full_name)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (user_id) DO UPDATE SET full_name = EXCLUDED.full_name, chat_id = EXCLUDED.chat_id
+        """, user_id, chat_id, full_name)
+    _cache["ts"] = 0.0
+
+async def get_member_count_cached(ttl=60):
+    """Returns the member count, served from memory within the TTL."""
+    now = time.monotonic()
+    if now - _cache["ts"] < ttl and _cache["count"] is not None:
+        return _cache["count"]
+    async with pool.acquire() as c:
+        count = await c.fetchval("SELECT COUNT(*) FROM members")
+    _cache.update(count=count, ts=now)
+    return count
+
+async def get_next_recipient():
+    """Advances the rotation and fetches the member whose turn it is.
+
+    The UPDATE...RETURNING is a single atomic statement, so two racing
+    triggers (e.g. /test during the daily job) can never pick the same
+    person or skip one. Returns (index, chat_id, full_name).
+    """
+    async with pool.acquire() as c:
+        next_index = await c.fetchval("""
+            UPDATE bot_state
+            SET current_index = (current_index + 1) % (SELECT COUNT(*) FROM members)
+            WHERE id = 1
+            RETURNING current_index
+        """)
+        # Same stable ordering as the rotation index; OFFSET picks one row.
+        row = await c.fetchrow("""
+            SELECT chat_id, full_name FROM members
+            ORDER BY joined_at ASC, user_id ASC
+            OFFSET $1 LIMIT 1
+        """, next_index)
+    return next_index, row["chat_id"], row["full_name"]
 
 # --- BOT COMMANDS ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -88,42 +105,67 @@ async def join(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     chat = update.effective_chat
     try:
-        add_user(user.id, chat.id, user.full_name)
+        await add_user(user.id, chat.id, user.full_name)
         await update.message.reply_text(f"✅ {user.full_name}, you have been added to the rotation!")
     except Exception as e:
         logging.error(f"DB Error: {e}")
         await update.message.reply_text("❌ Error joining database.")
 
 # --- ROTATION LOGIC ---
+# Cap concurrent sends and pace them at ~30/s so concurrent jobs
+# (e.g. /test firing during the daily run) stay under Telegram's global limit.
+SEND_SEMAPHORE = asyncio.Semaphore(25)
+
+# Bound .format once; only the name varies per send.
+HEY_TEMPLATE = "Hey {}, reminder to share any thanksgiving or devotions for the day! 🌞".format
+
+async def send_limited(bot, chat_id, text):
+    # Transient errors are collected and logged once after the retry loop,
+    # keeping I/O out of the send path itself.
+    failures = []
+    async with SEND_SEMAPHORE:
+        # Retry on flood control / transient network errors instead of
+        # dropping the reminder.
+        for attempt in range(3):
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                break
+            except RetryAfter as e:
+                failures.append(str(e))
+                if attempt == 2:
+                    raise
+                await asyncio.sleep(e.retry_after + 0.5)
+            except (TimedOut, NetworkError) as e:
+                failures.append(str(e))
+                if attempt == 2:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+        await asyncio.sleep(1 / 30)
+    if failures:
+        logging.warning("send to %s recovered after %d failed attempts: %s", chat_id, len(failures), failures)
+
 async def send_reminders(context: ContextTypes.DEFAULT_TYPE):
-    members, last_index = get_rotation_info()
-    
-    if not members:
+    total = await get_member_count_cached()
+
+    if not total:
         logging.warning("No members in rotation.")
         return
 
-    # Calculate next person
-    # logic: next_index = (last_index + 1) % total_members
-    # The '%' (modulo) operator makes it loop back to 0 automatically when it reaches the end.
-    next_index = (last_index + 1) % len(members)
-    
-    # Get the lucky person
-    chat_id, name = members[next_index]
-    
+    # Advance to the lucky person; the modulo in the UPDATE loops back to 0
+    # automatically when it reaches the end.
+    next_index, chat_id, name = await get_next_recipient()
+
     logging.info(f"It is {name}'s turn (Index: {next_index})")
 
     try:
         # Send message to the specific person
-        msg = f"Hey {name}, reminder to share any thanksgiving or devotions for the day! 🌞"
-        await context.bot.send_message(chat_id=chat_id, text=msg)
-        
+        msg = HEY_TEMPLATE(name)
+        await send_limited(context.bot, chat_id, msg)
+
         # ALSO: Send a message to the group if you want everyone to know?
         # If you want to notify the whole group who is on duty, you need the Group Chat ID.
         # For now, this sends to the individual's private chat or the group where they typed /join.
-        
-        # Save the new state so tomorrow we pick the next person
-        update_index(next_index)
-        
+
     except Exception as e:
         logging.error(f"Failed to send to {name}: {e}")
 
@@ -135,18 +177,27 @@ async def test_rotation(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # --- MAIN EXECUTION ---
 if __name__ == "__main__":
-    init_db()
-
-    application = Application.builder().token(TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .defaults(Defaults(tzinfo=ZoneInfo(TIMEZONE)))
+        .post_init(init_db)
+        .build()
+    )
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("join", join))
     application.add_handler(CommandHandler("test", test_rotation))
 
-    tz = pytz.timezone(TIMEZONE)
-    target_time = datetime.time(hour=8, minute=0, second=0, tzinfo=tz)
-    
+    # Naive time here: the JobQueue applies the tzinfo from Defaults.
     job_queue = application.job_queue
-    job_queue.run_daily(send_reminders, time=target_time)
-    
-    application.run_polling()
+    job_queue.run_daily(send_reminders, time=datetime.time(hour=8, minute=0))
+
+    # Webhook delivery instead of long-polling: no idle getUpdates cycle,
+    # and Telegram pushes updates to us as they happen.
+    application.run_webhook(
+        listen="0.0.0.0",
+        port=int(os.getenv("PORT", 8443)),
+        url_path=TOKEN,
+        webhook_url=f"https://{os.getenv('HOST')}/{TOKEN}",
+    )